@@ -0,0 +1,143 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+from elasticpath import add_to_cart, remove_from_cart
+
+
+CART_SYNC_DELAY = float(os.getenv('CART_SYNC_DELAY', 2))
+CART_SYNC_MAX_ATTEMPTS = 5
+
+logger = logging.getLogger("dvmn_bot_telegram")
+
+_condition = threading.Condition()
+_due_chats = {}
+_sync_attempts = {}
+_chat_locks = {}
+_sync_thread = None
+
+
+@contextmanager
+def _chat_lock(chat_id):
+    with _condition:
+        lock, users = _chat_locks.get(chat_id, (threading.Lock(), 0))
+        _chat_locks[chat_id] = (lock, users + 1)
+    try:
+        with lock:
+            yield
+    finally:
+        with _condition:
+            lock, users = _chat_locks[chat_id]
+            if users == 1:
+                del _chat_locks[chat_id]
+            else:
+                _chat_locks[chat_id] = (lock, users - 1)
+
+
+def _pop_pending(db, chat_id):
+    pipe = db.pipeline()
+    pipe.lrange(f'cart:{chat_id}:ops', 0, -1)
+    pipe.delete(f'cart:{chat_id}:ops')
+    ops, _ = pipe.execute()
+    pending = []
+    for op in ops:
+        op = json.loads(op)
+        previous = pending[-1] if pending else None
+        if op['action'] == 'add' and previous and previous['action'] == 'add' \
+                and previous['id'] == op['id']:
+            previous['quantity'] += op['quantity']
+        else:
+            pending.append(op)
+    return pending
+
+
+def _restore_pending(db, chat_id, pending):
+    if pending:
+        db.lpush(f'cart:{chat_id}:ops', *[json.dumps(op) for op in reversed(pending)])
+
+
+def _is_rejected(err):
+    response = getattr(err, 'response', None)
+    return (
+        isinstance(err, requests.exceptions.HTTPError) and response is not None
+        and 400 <= response.status_code < 500 and response.status_code != 429
+    )
+
+
+def sync_cart(db, chat_id):
+    with _chat_lock(chat_id):
+        pending = _pop_pending(db, chat_id)
+        while pending:
+            op = pending[0]
+            try:
+                if op['action'] == 'add':
+                    add_to_cart(product_id=op['id'], quantity=op['quantity'], chat_id=chat_id)
+                else:
+                    remove_from_cart(product_id=op['id'], chat_id=chat_id)
+            except Exception as err:
+                if not _is_rejected(err):
+                    _restore_pending(db, chat_id, pending)
+                    raise
+                logger.warning(f'ElasticPath отклонил изменение корзины {chat_id} {op}: {err}')
+            pending.pop(0)
+
+
+def _sync_worker(db):
+    while True:
+        with _condition:
+            while not _due_chats:
+                _condition.wait()
+            chat_id, due_at = min(_due_chats.items(), key=lambda item: item[1])
+            delay = due_at - time.monotonic()
+            if delay > 0:
+                _condition.wait(delay)
+                continue
+            del _due_chats[chat_id]
+        try:
+            sync_cart(db, chat_id)
+        except Exception as err:
+            with _condition:
+                attempts = _sync_attempts.get(chat_id, 0) + 1
+                if attempts >= CART_SYNC_MAX_ATTEMPTS:
+                    _sync_attempts.pop(chat_id, None)
+                else:
+                    _sync_attempts[chat_id] = attempts
+            if attempts >= CART_SYNC_MAX_ATTEMPTS:
+                logger.error(f'Не удалось синхронизировать корзину {chat_id}: {err}')
+            else:
+                _schedule_sync(db, chat_id, delay=CART_SYNC_DELAY * 2**attempts)
+        else:
+            with _condition:
+                _sync_attempts.pop(chat_id, None)
+
+
+def _schedule_sync(db, chat_id, delay=CART_SYNC_DELAY):
+    global _sync_thread
+    with _condition:
+        if _sync_thread is None:
+            _sync_thread = threading.Thread(target=_sync_worker, args=(db,), daemon=True)
+            _sync_thread.start()
+        _due_chats[chat_id] = time.monotonic() + delay
+        _condition.notify()
+
+
+def add_to_cart_mirror(db, chat_id, product_id, quantity):
+    db.rpush(f'cart:{chat_id}:ops', json.dumps(
+        {'action': 'add', 'id': product_id, 'quantity': int(quantity)}
+    ))
+    _schedule_sync(db, chat_id)
+
+
+def remove_from_cart_mirror(db, chat_id, item_id):
+    db.rpush(f'cart:{chat_id}:ops', json.dumps({'action': 'remove', 'id': item_id}))
+    _schedule_sync(db, chat_id)
+
+
+def reconcile_cart(db, chat_id):
+    with _condition:
+        _due_chats.pop(chat_id, None)
+    sync_cart(db, chat_id)
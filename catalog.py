@@ -0,0 +1,104 @@
+import os
+import threading
+import time
+
+import requests
+from database import InvalidationMarker
+from elasticpath import fetch_products, get_product, get_image_url
+from metrics import increment
+
+
+CATALOG_TTL = int(os.getenv('CATALOG_TTL', 60*60))
+CATALOG_RETRY_INTERVAL = 60
+
+_lock = threading.Lock()
+_initial_load_lock = threading.Lock()
+_products = []
+_products_by_id = {}
+_image_urls = {}
+_loaded_at = None
+_loaded_at_timestamp = 0
+_invalidation_marker = InvalidationMarker('catalog_invalidated_at')
+_version = 0
+_refreshing = False
+
+
+def _load_catalog():
+    global _products, _products_by_id, _loaded_at, _loaded_at_timestamp, _version
+    loaded_at_timestamp = time.time()
+    products = fetch_products()
+    with _lock:
+        if products != _products:
+            _version += 1
+        _products = products
+        _products_by_id = {product['id']: product for product in products}
+        _loaded_at = time.monotonic()
+        _loaded_at_timestamp = loaded_at_timestamp
+
+
+def _refresh_in_background():
+    global _refreshing, _loaded_at
+    try:
+        _load_catalog()
+    except requests.exceptions.RequestException:
+        with _lock:
+            _loaded_at = time.monotonic() - CATALOG_TTL + CATALOG_RETRY_INTERVAL
+    finally:
+        _refreshing = False
+
+
+def _ensure_fresh():
+    global _refreshing
+    if _loaded_at is None:
+        with _initial_load_lock:
+            if _loaded_at is None:
+                _load_catalog()
+        return
+    if time.monotonic() - _loaded_at < CATALOG_TTL \
+            and not _invalidation_marker.is_set_after(_loaded_at_timestamp):
+        return
+    with _lock:
+        if _refreshing:
+            return
+        _refreshing = True
+    threading.Thread(target=_refresh_in_background, daemon=True).start()
+
+
+def get_catalog_products():
+    _ensure_fresh()
+    return _products
+
+
+def get_catalog_product(product_id):
+    _ensure_fresh()
+    product = _products_by_id.get(product_id)
+    increment('bot_cache_requests_total', cache='catalog', result='miss' if product is None else 'hit')
+    if product is None:
+        product = get_product(product_id=product_id)
+        with _lock:
+            _products_by_id[product_id] = product
+    return product
+
+
+def get_catalog_image_url(file_id):
+    image_url = _image_urls.get(file_id)
+    increment('bot_cache_requests_total', cache='image_url', result='miss' if image_url is None else 'hit')
+    if image_url is None:
+        image_url = get_image_url(id=file_id)
+        with _lock:
+            _image_urls[file_id] = image_url
+    return image_url
+
+
+def get_catalog_version():
+    _ensure_fresh()
+    return _version
+
+
+def invalidate_catalog():
+    global _loaded_at
+    with _lock:
+        if _loaded_at is not None:
+            _loaded_at = time.monotonic() - CATALOG_TTL - 1
+        _image_urls.clear()
+    _invalidation_marker.set()
@@ -0,0 +1,58 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import observe, register_gauge
+
+
+logger = logging.getLogger("dvmn_bot_telegram")
+
+
+def record_handler_latency(handler_name, seconds):
+    observe('bot_handler_duration_seconds', seconds, handler=handler_name)
+
+
+class ChatDispatcher:
+    def __init__(self, workers):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.pending = {}
+        register_gauge('bot_dispatcher_queue_depth', self.get_queue_depth)
+        register_gauge('bot_dispatcher_active_chats', self.get_active_chats)
+
+    def submit(self, chat_id, func, *args):
+        with self.lock:
+            if chat_id in self.pending:
+                self.pending[chat_id].append((func, args))
+                return
+            self.pending[chat_id] = deque([(func, args)])
+        self.executor.submit(self._run_chat, chat_id)
+
+    def _run_chat(self, chat_id):
+        while True:
+            with self.lock:
+                tasks = self.pending[chat_id]
+                if not tasks:
+                    del self.pending[chat_id]
+                    return
+                func, args = tasks.popleft()
+            started_at = time.monotonic()
+            try:
+                func(*args)
+            except Exception as err:
+                logger.error(err)
+            finally:
+                record_handler_latency(func.__name__, time.monotonic() - started_at)
+
+    def get_queue_depth(self):
+        with self.lock:
+            return sum(len(tasks) for tasks in self.pending.values())
+
+    def get_active_chats(self):
+        with self.lock:
+            return len(self.pending)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
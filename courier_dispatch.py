@@ -0,0 +1,103 @@
+import json
+import logging
+import math
+import os
+
+from database import get_database_connection
+from send_scheduler import notification_priority
+
+
+DISPATCH_WINDOW = int(os.getenv('DISPATCH_WINDOW', 2*60))
+DISPATCH_MAX_STOPS = int(os.getenv('DISPATCH_MAX_STOPS', 4))
+DISPATCH_MAX_LEG_KM = float(os.getenv('DISPATCH_MAX_LEG_KM', 3))
+EARTH_RADIUS_KM = 6371
+
+logger = logging.getLogger("dvmn_bot_telegram")
+
+
+def get_distance_km(from_point, to_point):
+    lat1, lon1, lat2, lon2 = (
+        math.radians(float(coordinate)) for coordinate in (*from_point, *to_point)
+    )
+    haversine = (
+        math.sin((lat2 - lat1) / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(haversine))
+
+
+def get_order_point(order):
+    return order['latitude'], order['longitude']
+
+
+def build_routes(start_point, orders, max_stops=DISPATCH_MAX_STOPS, max_leg_km=DISPATCH_MAX_LEG_KM):
+    remaining = list(orders)
+    routes = []
+    while remaining:
+        route = []
+        position = start_point
+        while remaining and len(route) < max_stops:
+            nearest = min(remaining, key=lambda order: get_distance_km(position, get_order_point(order)))
+            if route and get_distance_km(position, get_order_point(nearest)) > max_leg_km:
+                break
+            route.append(nearest)
+            remaining.remove(nearest)
+            position = get_order_point(nearest)
+        routes.append(route)
+    return routes
+
+
+def format_route(pizzeria, route):
+    stops = [f"{pizzeria['Latitude']},{pizzeria['Longitude']}"]
+    stops += [f"{order['latitude']},{order['longitude']}" for order in route]
+    lines = [f'Маршрут доставки из пиццерии по адресу {pizzeria["address"]}, заказов: {len(route)}']
+    lines += [
+        f"{num}. {order['latitude']}, {order['longitude']}"
+        for num, order in enumerate(route, start=1)
+    ]
+    lines.append(f"https://yandex.ru/maps/?rtext={'~'.join(stops)}&rtt=auto")
+    return '\n'.join(lines)
+
+
+def enqueue_delivery(db, pizzeria, chat_id, longitude, latitude):
+    pipe = db.pipeline()
+    pipe.hset('dispatch_pizzerias', pizzeria['id'], json.dumps(pizzeria))
+    pipe.rpush(f'dispatch:{pizzeria["id"]}', json.dumps({
+        'chat_id': chat_id,
+        'longitude': longitude,
+        'latitude': latitude,
+    }))
+    pipe.execute()
+
+
+def dispatch_pizzeria_orders(bot, db, pizzeria):
+    pipe = db.pipeline()
+    pipe.lrange(f'dispatch:{pizzeria["id"]}', 0, -1)
+    pipe.delete(f'dispatch:{pizzeria["id"]}')
+    orders, _ = pipe.execute()
+    orders = [json.loads(order) for order in orders]
+    pizzeria_point = (pizzeria['Latitude'], pizzeria['Longitude'])
+    routes = build_routes(pizzeria_point, orders)
+    try:
+        with notification_priority():
+            while routes:
+                bot.send_message(
+                    text=format_route(pizzeria, routes[0]),
+                    chat_id=pizzeria['deliver_telegram_id'],
+                )
+                routes.pop(0)
+    except Exception:
+        unsent_orders = [json.dumps(order) for route in routes for order in route]
+        db.lpush(f'dispatch:{pizzeria["id"]}', *reversed(unsent_orders))
+        raise
+
+
+def callback_dispatch(bot, job):
+    db = get_database_connection()
+    for key in db.scan_iter('dispatch:*'):
+        pizzeria_id = key.decode('utf-8').split(':', 1)[1]
+        try:
+            pizzeria = json.loads(db.hget('dispatch_pizzerias', pizzeria_id))
+            dispatch_pizzeria_orders(bot, db, pizzeria)
+        except Exception as err:
+            logger.error(f'Не удалось отправить маршруты пиццерии {pizzeria_id}: {err}')
@@ -0,0 +1,77 @@
+import json
+import logging
+import queue
+import threading
+
+from elasticpath import create_entry, iterate_entries
+from pizzeria_distance import get_nearest_pizzeria
+
+
+logger = logging.getLogger("dvmn_bot_telegram")
+
+_write_behind_queue = queue.Queue()
+_write_behind_thread = None
+
+
+def _write_behind_worker():
+    while True:
+        data = _write_behind_queue.get()
+        try:
+            create_entry(flow_slug='customeraddress', data=data)
+        except Exception as err:
+            logger.error(f'Не удалось сохранить адрес в ElasticPath: {err}')
+        finally:
+            _write_behind_queue.task_done()
+
+
+def _schedule_write_behind(data):
+    global _write_behind_thread
+    if _write_behind_thread is None:
+        _write_behind_thread = threading.Thread(
+            target=_write_behind_worker, daemon=True,
+        )
+        _write_behind_thread.start()
+    _write_behind_queue.put(data)
+
+
+def save_customer_address(db, chat_id, longitude, latitude, pizzeria):
+    db.hmset(f'customeraddress:{chat_id}', {
+        'longitude': longitude,
+        'latitude': latitude,
+        'pizzeria': json.dumps(pizzeria),
+    })
+    _schedule_write_behind({
+        'telegram_chat_id': chat_id,
+        'longitude': longitude,
+        'latitude': latitude,
+    })
+
+
+def get_customer_address(db, chat_id):
+    stored = db.hgetall(f'customeraddress:{chat_id}')
+    if stored:
+        return {
+            'longitude': stored[b'longitude'].decode('utf-8'),
+            'latitude': stored[b'latitude'].decode('utf-8'),
+            'pizzeria': json.loads(stored[b'pizzeria']),
+        }
+
+    customer_address = None
+    for address in iterate_entries('customeraddress', prefetch=True):
+        if address['telegram_chat_id'] == str(chat_id):
+            customer_address = address
+    if customer_address is None:
+        return None
+    pizzeria = get_nearest_pizzeria(
+        (customer_address['longitude'], customer_address['latitude'])
+    )
+    db.hmset(f'customeraddress:{chat_id}', {
+        'longitude': customer_address['longitude'],
+        'latitude': customer_address['latitude'],
+        'pizzeria': json.dumps(pizzeria),
+    })
+    return {
+        'longitude': customer_address['longitude'],
+        'latitude': customer_address['latitude'],
+        'pizzeria': pizzeria,
+    }
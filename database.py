@@ -0,0 +1,52 @@
+import os
+import time
+
+import redis
+
+
+REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', 20))
+REDIS_TIMEOUT = float(os.getenv('REDIS_TIMEOUT', 5))
+REDIS_SHARED = bool(os.getenv('REDIS_HOST'))
+INVALIDATION_CHECK_INTERVAL = 10
+
+_database = None
+
+
+def get_database_connection():
+    global _database
+    if _database is None:
+        database_password = os.getenv("REDIS_PASSWORD")
+        database_host = os.getenv("REDIS_HOST")
+        database_port = os.getenv("REDIS_PORT")
+        database_number = int(os.getenv("REDIS_DB", 0))
+        connection_pool = redis.BlockingConnectionPool(
+            host=database_host,
+            port=database_port,
+            password=database_password,
+            db=database_number,
+            max_connections=REDIS_MAX_CONNECTIONS,
+            timeout=REDIS_TIMEOUT,
+            socket_timeout=REDIS_TIMEOUT,
+            socket_connect_timeout=REDIS_TIMEOUT,
+            socket_keepalive=True,
+        )
+        _database = redis.Redis(connection_pool=connection_pool)
+    return _database
+
+
+class InvalidationMarker:
+    def __init__(self, key, check_interval=INVALIDATION_CHECK_INTERVAL):
+        self.key = key
+        self.check_interval = check_interval
+        self.checked_at = 0
+
+    def is_set_after(self, timestamp):
+        if not REDIS_SHARED or time.monotonic() - self.checked_at < self.check_interval:
+            return False
+        self.checked_at = time.monotonic()
+        invalidated_at = get_database_connection().get(self.key)
+        return invalidated_at is not None and float(invalidated_at) > timestamp
+
+    def set(self):
+        if REDIS_SHARED:
+            get_database_connection().set(self.key, time.time())
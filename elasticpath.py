@@ -1,57 +1,151 @@
-import requests
 import os
-from datetime import timedelta, datetime
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+from database import REDIS_SHARED, get_database_connection
+from http_client import HTTP_POOL_SIZE, HTTP_TIMEOUT, send_request
 
-EP_ACCESS_TOKEN = EP_TOKEN_TIME = None
 
+EP_API_URL = os.getenv('EP_API_URL', 'https://api.moltin.com')
+EP_PAGE_SIZE = int(os.getenv('EP_PAGE_SIZE', 100))
+MINOR_UNITS_PER_AMOUNT = 100
+EP_TOKEN_REFRESH_MARGIN = 5*60
 
-def fetch_products():
-    url = 'https://api.moltin.com/v2/products'
-    headers = {'Authorization': f'Bearer {get_ep_access_token()}'}
-    response = requests.get(url, headers=headers)
+_fetch_executor = None
+_token_lock = threading.Lock()
+_token = None
+_token_expires_at = 0
+
+
+def is_token_fresh(token, expires_at):
+    return token is not None and time.time() < expires_at - EP_TOKEN_REFRESH_MARGIN
+
+
+def request_ep_access_token():
+    url = f'{EP_API_URL}/oauth/access_token'
+    payload = {
+        'grant_type': 'client_credentials',
+        'client_secret': os.environ.get('EP_CLIENT_SECRET'),
+        'client_id': os.environ.get('EP_CLIENT_ID'),
+    }
+    response = send_request('post', url, data=payload, timeout=HTTP_TIMEOUT)
     response.raise_for_status()
-    return response.json()['data']
+    token_info = response.json()
+    expires_at = token_info.get('expires') or time.time() + token_info['expires_in']
+    return token_info['access_token'], expires_at
+
+
+def load_shared_token():
+    db = get_database_connection()
+    token, expires_at = db.mget('ep_token', 'ep_token_expires_at')
+    if token is None or expires_at is None:
+        return None, 0
+    return token.decode('utf-8'), float(expires_at)
+
+
+def refresh_shared_token(rejected_token):
+    db = get_database_connection()
+    with db.lock('ep_token_lock', timeout=HTTP_TIMEOUT*2, blocking_timeout=HTTP_TIMEOUT*2):
+        token, expires_at = load_shared_token()
+        if token != rejected_token and is_token_fresh(token, expires_at):
+            return token, expires_at
+        token, expires_at = request_ep_access_token()
+        ttl = max(int(expires_at - time.time()), 1)
+        pipe = db.pipeline()
+        pipe.set('ep_token', token, ex=ttl)
+        pipe.set('ep_token_expires_at', expires_at, ex=ttl)
+        pipe.execute()
+        return token, expires_at
+
+
+def get_ep_access_token(rejected_token=None):
+    global _token, _token_expires_at
+    token = _token
+    if token != rejected_token and is_token_fresh(token, _token_expires_at):
+        return token
+
+    with _token_lock:
+        if _token != rejected_token and is_token_fresh(_token, _token_expires_at):
+            return _token
+        if REDIS_SHARED:
+            token, expires_at = load_shared_token()
+            if token == rejected_token or not is_token_fresh(token, expires_at):
+                token, expires_at = refresh_shared_token(rejected_token)
+        else:
+            token, expires_at = request_ep_access_token()
+        _token, _token_expires_at = token, expires_at
+        return _token
+
+
+def ep_request(method, url, timeout=None, auth=True, headers=None, **kwargs):
+    headers = dict(headers or {})
+    if auth:
+        token = get_ep_access_token()
+        headers['Authorization'] = f'Bearer {token}'
+    response = send_request(
+        method, url, headers=headers, timeout=timeout or HTTP_TIMEOUT, **kwargs
+    )
+    if auth and response.status_code == 401:
+        token = get_ep_access_token(rejected_token=token)
+        headers['Authorization'] = f'Bearer {token}'
+        response = send_request(
+            method, url, headers=headers, timeout=timeout or HTTP_TIMEOUT, **kwargs
+        )
+    response.raise_for_status()
+    return response
+
+
+def get_fetch_executor():
+    global _fetch_executor
+    if _fetch_executor is None:
+        _fetch_executor = ThreadPoolExecutor(max_workers=HTTP_POOL_SIZE)
+    return _fetch_executor
+
+
+def fetch_page(url, params=None):
+    return ep_request('get', url, params=params).json()
+
+
+def iterate_pages(url, page_size=None, prefetch=False):
+    page_size = page_size or EP_PAGE_SIZE
+    page = fetch_page(url, params={'page[limit]': page_size})
+    while True:
+        items = page['data']
+        next_url = (page.get('links') or {}).get('next') if items else None
+        next_page = None
+        if next_url and prefetch:
+            next_page = get_fetch_executor().submit(fetch_page, next_url)
+        yield from items
+        if not next_url:
+            return
+        page = next_page.result() if next_page else fetch_page(next_url)
+
+
+def iterate_products(page_size=None, prefetch=False):
+    url = f'{EP_API_URL}/v2/products'
+    return iterate_pages(url, page_size=page_size, prefetch=prefetch)
+
+
+def fetch_products():
+    return list(iterate_products(prefetch=True))
 
 
 def get_image_url(id):
-    url = f'https://api.moltin.com/v2/files/{id}'
-    headers = {'Authorization': f'Bearer {get_ep_access_token()}'}
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
+    url = f'{EP_API_URL}/v2/files/{id}'
+    response = ep_request('get', url)
     return response.json()['data']['link']['href']
 
 
 def get_product(product_id):
-    url = f'https://api.moltin.com/v2/products/{product_id}'
-    headers = {'Authorization': f'Bearer {get_ep_access_token()}'}
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
+    url = f'{EP_API_URL}/v2/products/{product_id}'
+    response = ep_request('get', url)
     return response.json()['data']
 
 
-def get_ep_access_token():
-    global EP_ACCESS_TOKEN
-    global EP_TOKEN_TIME
-
-    if not EP_ACCESS_TOKEN or datetime.now() > EP_TOKEN_TIME + timedelta(hours=1):
-        url = 'https://api.moltin.com/oauth/access_token'
-        payload = {
-            'grant_type': 'client_credentials',
-            'client_secret': os.environ.get('EP_CLIENT_SECRET'),
-            'client_id': os.environ.get('EP_CLIENT_ID'),
-        }
-        response = requests.post(url, data=payload)
-        response.raise_for_status()
-        EP_ACCESS_TOKEN = response.json()['access_token']
-        EP_TOKEN_TIME = datetime.now()
-    return EP_ACCESS_TOKEN
-
-
 def add_to_cart(product_id, quantity, chat_id):
-    url = f'https://api.moltin.com/v2/carts/:{chat_id}/items'
+    url = f'{EP_API_URL}/v2/carts/:{chat_id}/items'
     headers = {
-        'Authorization': f'Bearer {get_ep_access_token()}',
         'Content-Type': 'application/json',
     }
     payload = {
@@ -61,43 +155,42 @@ def add_to_cart(product_id, quantity, chat_id):
             'type': 'cart_item',
         }
     }
-    response = requests.post(url, json=payload, headers=headers)
-    response.raise_for_status()
+    ep_request('post', url, json=payload, headers=headers)
 
 
 def remove_from_cart(product_id, chat_id):
-    url = f'https://api.moltin.com/v2/carts/:{chat_id}/items/{product_id}'
-    headers = {'Authorization': f'Bearer {get_ep_access_token()}', }
-    response = requests.delete(url, headers=headers)
-    response.raise_for_status()
+    url = f'{EP_API_URL}/v2/carts/:{chat_id}/items/{product_id}'
+    ep_request('delete', url)
 
 
 def get_carts_products(chat_id):
-    url = f'https://api.moltin.com/v2/carts/:{chat_id}/items'
-    headers = {
-        'Authorization': f'Bearer {get_ep_access_token()}',
-    }
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
+    url = f'{EP_API_URL}/v2/carts/:{chat_id}/items'
+    response = ep_request('get', url)
 
     return response.json()['data']
 
 
 def get_total_price(chat_id):
-    url = f'https://api.moltin.com/v2/carts/:{chat_id}'
-    headers = {
-        'Authorization': f'Bearer {get_ep_access_token()}',
-    }
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
+    url = f'{EP_API_URL}/v2/carts/:{chat_id}'
+    response = ep_request('get', url)
     return response.json()['data']['meta']['display_price']['with_tax']['formatted']
 
 
-def create_customer(name, email):
-    url = 'https://api.moltin.com/v2/customers/'
-    headers = {
-        'Authorization': f'Bearer {get_ep_access_token()}',
+def get_cart_summary(chat_id):
+    items = get_carts_products(chat_id)
+    amount = sum(
+        item['meta']['display_price']['with_tax']['value']['amount']
+        for item in items
+    )
+    return {
+        'items': items,
+        'amount': amount,
+        'total': int(round(amount*MINOR_UNITS_PER_AMOUNT)),
     }
+
+
+def create_customer(name, email):
+    url = f'{EP_API_URL}/v2/customers/'
     payload = {
         'data': {
             'type': 'customer',
@@ -105,15 +198,11 @@ def create_customer(name, email):
             'email': email,
         }
     }
-    response = requests.post(url, json=payload, headers=headers)
-    response.raise_for_status()
+    ep_request('post', url, json=payload)
 
 
 def create_product(name, slug, sku, description, amount, currency='RUB', manage_stock=False, includes_tax=True, status='live', commodity_type='physical'):
-    url = 'https://api.moltin.com/v2/products'
-    headers = {
-        'Authorization': f'Bearer {get_ep_access_token()}',
-    }
+    url = f'{EP_API_URL}/v2/products'
     payload = {
         'data': {
             'type': 'product',
@@ -133,53 +222,60 @@ def create_product(name, slug, sku, description, amount, currency='RUB', manage_
             'commodity_type': commodity_type,
         }
     }
-    response = requests.post(url, json=payload, headers=headers)
-    response.raise_for_status()
+    response = ep_request('post', url, json=payload)
     return response.json()['data']['id']
 
 
-def upload_file(file_url, public=True):
-    response = requests.get(file_url)
-    response.raise_for_status()
-    filename = file_url.split('/')[-1]
-    try:
-        with open(filename, 'wb') as f:
-            f.write(response.content)
-        url = 'https://api.moltin.com/v2/files'
-        headers = {
-            'Authorization': f'Bearer {get_ep_access_token()}',
-        }
-        files = {
-            'file': (filename, open(filename, 'rb')),
-            'public': (None, 'true'),
-        }
-        response = requests.post(url, files=files, headers=headers)
-        response.raise_for_status()
-    finally:
-        os.remove(filename)
+def update_product(product_id, data):
+    url = f'{EP_API_URL}/v2/products/{product_id}'
+    data['type'] = 'product'
+    data['id'] = product_id
+    payload = {
+        'data': data,
+    }
+    response = ep_request('put', url, json=payload)
     return response.json()['data']['id']
 
 
-def create_relationships(product_id, file_id):
-    url = f'https://api.moltin.com/v2/products/{product_id}/relationships/main-image'
-    headers = {
-        'Authorization': f'Bearer {get_ep_access_token()}',
+def delete_product(product_id):
+    url = f'{EP_API_URL}/v2/products/{product_id}'
+    ep_request('delete', url)
+
+
+def iterate_files(page_size=None, prefetch=False):
+    url = f'{EP_API_URL}/v2/files'
+    return iterate_pages(url, page_size=page_size, prefetch=prefetch)
+
+
+def fetch_files():
+    return list(iterate_files(prefetch=True))
+
+
+def upload_file(file_url, public=True, filename=None):
+    response = ep_request('get', file_url, auth=False)
+    filename = filename or file_url.split('/')[-1]
+    url = f'{EP_API_URL}/v2/files'
+    files = {
+        'file': (filename, response.content),
+        'public': (None, 'true' if public else 'false'),
     }
+    response = ep_request('post', url, files=files)
+    return response.json()['data']['id']
+
+
+def create_relationships(product_id, file_id):
+    url = f'{EP_API_URL}/v2/products/{product_id}/relationships/main-image'
     payload = {
         'data': {
             'type': 'main_image',
             'id': file_id,
         }
     }
-    response = requests.post(url, json=payload, headers=headers)
-    response.raise_for_status()
+    ep_request('post', url, json=payload)
 
 
 def create_flow(name, slug, description, enabled=True):
-    url = 'https://api.moltin.com/v2/flows'
-    headers = {
-        'Authorization': f'Bearer {get_ep_access_token()}',
-    }
+    url = f'{EP_API_URL}/v2/flows'
     payload = {
         'data': {
             'type': 'flow',
@@ -189,16 +285,12 @@ def create_flow(name, slug, description, enabled=True):
             'enabled': enabled,
         }
     }
-    response = requests.post(url, json=payload, headers=headers)
-    response.raise_for_status()
+    response = ep_request('post', url, json=payload)
     return response.json()['data']['id']
 
 
 def create_field(name, slug, field_type, description, required, enabled, flow_id):
-    url = 'https://api.moltin.com/v2/fields'
-    headers = {
-        'Authorization': f'Bearer {get_ep_access_token()}',
-    }
+    url = f'{EP_API_URL}/v2/fields'
     payload = {
         'data': {
             'type': 'field',
@@ -218,45 +310,40 @@ def create_field(name, slug, field_type, description, required, enabled, flow_id
             }
         }
     }
-    response = requests.post(url, json=payload, headers=headers)
-    response.raise_for_status()
+    response = ep_request('post', url, json=payload)
     return response.json()['data']['id']
 
 
 def create_entry(flow_slug, data):
     data['type'] = 'entry'
-    url = f'https://api.moltin.com/v2/flows/{flow_slug}/entries'
-    headers = {
-        'Authorization': f'Bearer {get_ep_access_token()}',
-    }
+    url = f'{EP_API_URL}/v2/flows/{flow_slug}/entries'
     payload = {
         'data': data,
     }
-    response = requests.post(url, json=payload, headers=headers)
-    response.raise_for_status()
+    response = ep_request('post', url, json=payload)
     return response.json()['data']['id']
 
 
 def update_entry(flow_slug, entry_id, data):
-    url = f'https://api.moltin.com/v2/flows/{flow_slug}/entries/{entry_id}'
-    headers = {
-        'Authorization': f'Bearer {get_ep_access_token()}',
-    }
+    url = f'{EP_API_URL}/v2/flows/{flow_slug}/entries/{entry_id}'
     data['type'] = 'entry'
-    data['id'] = 'entryID'
+    data['id'] = entry_id
     payload = {
         'data': data,
     }
-    response = requests.put(url, json=payload, headers=headers)
-    response.raise_for_status()
+    response = ep_request('put', url, json=payload)
     return response.json()['data']['id']
 
 
+def delete_entry(flow_slug, entry_id):
+    url = f'{EP_API_URL}/v2/flows/{flow_slug}/entries/{entry_id}'
+    ep_request('delete', url)
+
+
+def iterate_entries(flow_slug, page_size=None, prefetch=False):
+    url = f'{EP_API_URL}/v2/flows/{flow_slug}/entries'
+    return iterate_pages(url, page_size=page_size, prefetch=prefetch)
+
+
 def get_entries(flow_slug):
-    url = f'https://api.moltin.com/v2/flows/{flow_slug}/entries'
-    headers = {
-        'Authorization': f'Bearer {get_ep_access_token()}',
-    }
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    return response.json()['data']
+    return list(iterate_entries(flow_slug, prefetch=True))
@@ -0,0 +1,245 @@
+import json
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+
+class FakeServices:
+    def __init__(self, menu, pizzerias, latency=0.05, deliver_telegram_id=1):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.carts = {}
+        self.files = {}
+        self.products = []
+        self.entries = {'pizzeria': [], 'customeraddress': []}
+        self.message_id = 0
+        for menu_item in menu:
+            file_id = str(uuid.uuid4())
+            image_url = menu_item['product_image']['url']
+            self.files[file_id] = {
+                'id': file_id,
+                'type': 'file',
+                'file_name': image_url.split('/')[-1],
+                'link': {'href': image_url},
+            }
+            self.products.append({
+                'id': str(uuid.uuid4()),
+                'type': 'product',
+                'name': menu_item['name'],
+                'slug': str(menu_item['id']),
+                'sku': str(menu_item['id']),
+                'description': menu_item['description'],
+                'price': [{'amount': menu_item['price'], 'currency': 'RUB', 'includes_tax': True}],
+                'relationships': {'main_image': {'data': {'type': 'main_image', 'id': file_id}}},
+            })
+        for pizzeria in pizzerias:
+            self.entries['pizzeria'].append({
+                'id': str(uuid.uuid4()),
+                'type': 'entry',
+                'address': pizzeria['address']['full'],
+                'alias': pizzeria['alias'],
+                'Longitude': pizzeria['coordinates']['lon'],
+                'Latitude': pizzeria['coordinates']['lat'],
+                'deliver_telegram_id': deliver_telegram_id,
+            })
+        self.routes = [
+            ('POST', r'/oauth/access_token', self.get_token),
+            ('GET', r'/v2/products', self.list_products),
+            ('GET', r'/v2/products/(?P<product_id>[^/]+)', self.get_product),
+            ('GET', r'/v2/files/(?P<file_id>[^/]+)', self.get_file),
+            ('GET', r'/v2/carts/:(?P<cart_id>[^/]+)/items', self.get_cart_items),
+            ('POST', r'/v2/carts/:(?P<cart_id>[^/]+)/items', self.add_cart_item),
+            ('DELETE', r'/v2/carts/:(?P<cart_id>[^/]+)/items/(?P<item_id>[^/]+)', self.remove_cart_item),
+            ('GET', r'/v2/carts/:(?P<cart_id>[^/]+)', self.get_cart),
+            ('POST', r'/v2/customers/?', self.create_customer),
+            ('GET', r'/v2/flows/(?P<flow_slug>[^/]+)/entries', self.list_entries),
+            ('POST', r'/v2/flows/(?P<flow_slug>[^/]+)/entries', self.create_entry),
+            ('GET', r'/1.x', self.geocode),
+            ('POST', r'/bot[^/]+/(?P<api_method>\w+)', self.telegram),
+        ]
+
+    def start(self, port=0):
+        services = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def handle_request(self):
+                services.dispatch(self)
+
+            do_GET = do_POST = do_PUT = do_DELETE = handle_request
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), RequestHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        host, port = self.server.server_address
+        self.base_url = f'http://{host}:{port}'
+        return self.base_url
+
+    def stop(self):
+        self.server.shutdown()
+
+    def reset_calls(self):
+        with self.lock:
+            self.calls = {}
+
+    def dispatch(self, request):
+        url = urlsplit(request.path)
+        content_length = int(request.headers.get('Content-Length', 0))
+        body = request.rfile.read(content_length) if content_length else b''
+        for method, pattern, handler in self.routes:
+            match = re.fullmatch(pattern, url.path)
+            if request.command != method or not match:
+                continue
+            with self.lock:
+                name = handler.__name__
+                self.calls[name] = self.calls.get(name, 0) + 1
+            time.sleep(self.latency)
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            status, payload = handler(query=query, body=body, **match.groupdict())
+            break
+        else:
+            status, payload = 404, {'errors': [{'detail': 'Not found'}]}
+        response = json.dumps(payload).encode('utf-8')
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(response)))
+        request.end_headers()
+        request.wfile.write(response)
+
+    def paginate(self, items, query, path):
+        limit = int(query.get('page[limit]', 100))
+        offset = int(query.get('page[offset]', 0))
+        page = items[offset:offset+limit]
+        next_url = None
+        if offset + limit < len(items):
+            next_query = urlencode({'page[limit]': limit, 'page[offset]': offset + limit})
+            next_url = f'{self.base_url}{path}?{next_query}'
+        return 200, {'data': page, 'links': {'next': next_url}}
+
+    def get_token(self, query, body):
+        return 200, {
+            'access_token': uuid.uuid4().hex,
+            'expires': int(time.time()) + 3600,
+            'expires_in': 3600,
+            'token_type': 'Bearer',
+        }
+
+    def list_products(self, query, body):
+        return self.paginate(self.products, query, '/v2/products')
+
+    def get_product(self, query, body, product_id):
+        for product in self.products:
+            if product['id'] == product_id:
+                return 200, {'data': product}
+        return 404, {'errors': [{'detail': 'Not found'}]}
+
+    def get_file(self, query, body, file_id):
+        if file_id not in self.files:
+            return 404, {'errors': [{'detail': 'Not found'}]}
+        return 200, {'data': self.files[file_id]}
+
+    def get_cart_items(self, query, body, cart_id):
+        with self.lock:
+            items = list(self.carts.get(cart_id, {}).values())
+        return 200, {'data': items}
+
+    def add_cart_item(self, query, body, cart_id):
+        data = json.loads(body)['data']
+        product, *_ = [product for product in self.products if product['id'] == data['id']]
+        unit_price = product['price'][0]['amount']
+        with self.lock:
+            cart = self.carts.setdefault(cart_id, {})
+            item = cart.get(product['id'])
+            quantity = data['quantity'] + (item['quantity'] if item else 0)
+            cart[product['id']] = {
+                'id': item['id'] if item else str(uuid.uuid4()),
+                'type': 'cart_item',
+                'product_id': product['id'],
+                'name': product['name'],
+                'description': product['description'],
+                'quantity': quantity,
+                'meta': {
+                    'display_price': {
+                        'with_tax': {
+                            'unit': {'amount': unit_price},
+                            'value': {'amount': unit_price*quantity},
+                        }
+                    }
+                },
+            }
+            items = list(cart.values())
+        return 201, {'data': items}
+
+    def remove_cart_item(self, query, body, cart_id, item_id):
+        with self.lock:
+            cart = self.carts.get(cart_id, {})
+            for product_id, item in list(cart.items()):
+                if item['id'] == item_id:
+                    del cart[product_id]
+            items = list(cart.values())
+        return 200, {'data': items}
+
+    def get_cart(self, query, body, cart_id):
+        with self.lock:
+            amount = sum(
+                item['meta']['display_price']['with_tax']['value']['amount']
+                for item in self.carts.get(cart_id, {}).values()
+            )
+        return 200, {
+            'data': {
+                'id': cart_id,
+                'meta': {'display_price': {'with_tax': {'amount': amount, 'formatted': str(amount)}}},
+            }
+        }
+
+    def create_customer(self, query, body):
+        return 201, {'data': dict(json.loads(body)['data'], id=str(uuid.uuid4()))}
+
+    def list_entries(self, query, body, flow_slug):
+        with self.lock:
+            entries = list(self.entries.get(flow_slug, []))
+        return self.paginate(entries, query, f'/v2/flows/{flow_slug}/entries')
+
+    def create_entry(self, query, body, flow_slug):
+        entry = dict(json.loads(body)['data'], id=str(uuid.uuid4()))
+        entry = {key: str(value) for key, value in entry.items()}
+        with self.lock:
+            self.entries.setdefault(flow_slug, []).append(entry)
+        return 201, {'data': entry}
+
+    def geocode(self, query, body):
+        pizzeria = self.entries['pizzeria'][hash(query.get('geocode', '')) % len(self.entries['pizzeria'])]
+        position = f"{float(pizzeria['Longitude']) + 0.01} {float(pizzeria['Latitude']) + 0.01}"
+        return 200, {
+            'response': {
+                'GeoObjectCollection': {
+                    'featureMember': [{'GeoObject': {'Point': {'pos': position}}}],
+                }
+            }
+        }
+
+    def telegram(self, query, body, api_method):
+        if api_method in ('deleteMessage', 'answerCallbackQuery', 'answerPreCheckoutQuery',
+                          'editMessageText', 'editMessageReplyMarkup', 'editMessageMedia',
+                          'setWebhook', 'deleteWebhook'):
+            return 200, {'ok': True, 'result': True}
+        data = json.loads(body) if body.startswith(b'{') else {}
+        with self.lock:
+            self.message_id += 1
+            message_id = self.message_id
+        message = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': int(data.get('chat_id', 0)), 'type': 'private'},
+        }
+        if api_method == 'sendPhoto':
+            message['photo'] = [{'file_id': uuid.uuid4().hex, 'width': 100, 'height': 100}]
+        return 200, {'ok': True, 'result': message}
@@ -0,0 +1,150 @@
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import Timer, increment, register_gauge
+
+
+HTTP_POOL_SIZE = int(os.getenv('EP_POOL_SIZE', 10))
+HTTP_TIMEOUT = float(os.getenv('EP_TIMEOUT', 10))
+HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', 3))
+HTTP_BACKOFF = 0.5
+HTTP_BACKOFF_MAX = 10
+HTTP_RETRY_AFTER_MAX = 30
+HTTP_BREAKER_THRESHOLD = 5
+HTTP_BREAKER_TIMEOUT = 30
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'}
+
+_session = None
+_breakers_lock = threading.Lock()
+_breakers = {}
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, host):
+        self.host = host
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def before_request(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if time.monotonic() - self.opened_at < HTTP_BREAKER_TIMEOUT or self.trial_running:
+                raise CircuitOpenError(f'Сервис {self.host} временно недоступен')
+            self.trial_running = True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.opened_at is not None or self.failures >= HTTP_BREAKER_THRESHOLD:
+                self.opened_at = time.monotonic()
+
+
+def get_session():
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE,
+        )
+        _session.mount('https://', adapter)
+        _session.mount('http://', adapter)
+    return _session
+
+
+def get_connection_stats():
+    opened = requests_made = 0
+    if _session is not None:
+        for adapter in set(_session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                opened += pool.num_connections
+                requests_made += pool.num_requests
+    return {
+        'requests': requests_made,
+        'opened': opened,
+        'reused': requests_made - opened,
+    }
+
+
+for stat_name in ('requests', 'opened', 'reused'):
+    register_gauge(
+        f'bot_http_connections_{stat_name}',
+        lambda stat_name=stat_name: get_connection_stats()[stat_name],
+    )
+
+
+def get_circuit_breaker(url):
+    host = urlsplit(url).netloc
+    with _breakers_lock:
+        if host not in _breakers:
+            _breakers[host] = CircuitBreaker(host)
+        return _breakers[host]
+
+
+def get_retry_delay(attempt, response=None):
+    retry_after = response is not None and response.headers.get('Retry-After')
+    if retry_after and retry_after.isdigit():
+        return min(int(retry_after), HTTP_RETRY_AFTER_MAX)
+    return random.uniform(0, min(HTTP_BACKOFF * 2**attempt, HTTP_BACKOFF_MAX))
+
+
+def send_request(method, url, timeout=None, retries=HTTP_RETRIES, **kwargs):
+    method = method.upper()
+    breaker = get_circuit_breaker(url)
+    for attempt in range(retries + 1):
+        if attempt:
+            increment('bot_upstream_retries_total', host=breaker.host)
+        breaker.before_request()
+        try:
+            with Timer('bot_upstream_request_duration_seconds', host=breaker.host, method=method):
+                response = get_session().request(
+                    method, url, timeout=timeout or HTTP_TIMEOUT, **kwargs
+                )
+        except requests.exceptions.ConnectTimeout:
+            breaker.record_failure()
+            if attempt == retries:
+                raise
+            time.sleep(get_retry_delay(attempt))
+            continue
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            breaker.record_failure()
+            if attempt == retries or method not in IDEMPOTENT_METHODS:
+                raise
+            time.sleep(get_retry_delay(attempt))
+            continue
+        except Exception:
+            breaker.record_failure()
+            raise
+
+        if response.status_code not in RETRY_STATUSES or response.status_code == 429:
+            breaker.record_success()
+        else:
+            breaker.record_failure()
+        if response.status_code not in RETRY_STATUSES:
+            return response
+        if attempt == retries or (response.status_code != 429 and method not in IDEMPOTENT_METHODS):
+            return response
+        time.sleep(get_retry_delay(attempt, response))
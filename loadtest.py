@@ -0,0 +1,172 @@
+import argparse
+import json
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fake_services import FakeServices
+
+
+SCENARIOS = {
+    'browse': [
+        ('message', '/start'),
+        ('callback', 'page 2'),
+        ('callback', '{product}'),
+        ('callback', 'HANDLE_MENU'),
+        ('callback', '{product}'),
+        ('callback', 'HANDLE_MENU'),
+    ],
+    'order': [
+        ('message', '/start'),
+        ('callback', '{product}'),
+        ('callback', '{product} 1'),
+        ('callback', '{product} 5'),
+        ('callback', 'HANDLE_MENU'),
+        ('callback', 'HANDLE_CART'),
+        ('callback', 'WAITING_EMAIL'),
+        ('message', 'load@example.com'),
+        ('message', 'Москва, улица Тверская, дом {chat_id}'),
+        ('callback', 'DELIVERY'),
+    ],
+}
+
+
+def build_update(update_id, chat_id, kind, text):
+    user = {'id': chat_id, 'is_bot': False, 'first_name': 'Load'}
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'private', 'first_name': 'Load'},
+        'from': user,
+    }
+    if kind == 'message':
+        return {'update_id': update_id, 'message': dict(message, text=text)}
+    message['text'] = 'Meню:'
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'from': user,
+            'chat_instance': str(chat_id),
+            'data': text,
+            'message': message,
+        },
+    }
+
+
+def get_percentile(latencies, percent):
+    if not latencies:
+        return 0
+    index = min(len(latencies) - 1, int(len(latencies) * percent / 100))
+    return sorted(latencies)[index]
+
+
+def run_scenario(name, steps, users, concurrency, products, handle_update):
+    first_chat_id = random.randint(10**8, 10**9)
+
+    def run_session(chat_id):
+        product = random.choice(products)['id']
+        latencies, errors = [], 0
+        for step_num, (kind, text) in enumerate(steps):
+            update_data = build_update(
+                step_num + 1, chat_id, kind, text.format(product=product, chat_id=chat_id),
+            )
+            started_at = time.monotonic()
+            try:
+                handle_update(update_data)
+            except Exception as err:
+                errors += 1
+                print(f'{name}: чат {chat_id}, шаг {step_num + 1}: {err!r}')
+            latencies.append(time.monotonic() - started_at)
+        return latencies, errors
+
+    started_at = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(run_session, range(first_chat_id, first_chat_id + users)))
+    elapsed = time.monotonic() - started_at
+    latencies = [latency for session_latencies, _ in results for latency in session_latencies]
+    return {
+        'updates': len(latencies),
+        'errors': sum(errors for _, errors in results),
+        'throughput': len(latencies) / elapsed,
+        'p50': get_percentile(latencies, 50),
+        'p95': get_percentile(latencies, 95),
+        'p99': get_percentile(latencies, 99),
+    }
+
+
+def print_report(name, report, calls):
+    print(f'\n=== {name} ===')
+    print(
+        f"обновлений: {report['updates']}, ошибок: {report['errors']}, "
+        f"{report['throughput']:.1f} обн/с"
+    )
+    print(
+        f"p50 {report['p50']*1000:.0f} мс, p95 {report['p95']*1000:.0f} мс, "
+        f"p99 {report['p99']*1000:.0f} мс"
+    )
+    print('запросы к внешним сервисам:')
+    for call_name, count in sorted(calls.items()):
+        print(f'  {call_name}: {count}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест бота на локальных заглушках внешних API')
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), action='append')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.05, help='задержка ответа заглушек, с')
+    parser.add_argument('--menu', default='menu.json')
+    parser.add_argument('--addresses', default='addresses.json')
+    parser.add_argument('--redis-db', type=int, default=15, help='номер отдельной базы redis для теста')
+    args = parser.parse_args()
+
+    with open(args.menu, 'r') as f:
+        menu = json.load(f)
+    with open(args.addresses, 'r') as f:
+        pizzerias = json.load(f)
+    fake_services = FakeServices(menu, pizzerias, latency=args.latency)
+    base_url = fake_services.start()
+
+    os.environ['EP_API_URL'] = base_url
+    os.environ['YANDEX_GEOCODER_URL'] = base_url
+    os.environ.setdefault('YANDEX_GEO_API', 'loadtest')
+    os.environ.setdefault('TRANZZO_API', 'loadtest')
+    os.environ['REDIS_DB'] = str(args.redis_db)
+
+    # Адреса сервисов читаются при импорте, поэтому бот импортируется после настройки окружения
+    from telegram import Bot, Update
+    from telegram.ext import JobQueue
+    from cart_mirror import CART_SYNC_DELAY
+    from catalog import get_catalog_products
+    from database import get_database_connection
+    from telegram_bot import handle_users_reply, instrument_telegram_bot
+
+    bot = Bot('123:loadtest', base_url=f'{base_url}/bot')
+    instrument_telegram_bot(bot)
+    job_queue = JobQueue(bot)
+    db = get_database_connection()
+    existing_keys = set(db.scan_iter())
+
+    def handle_update(update_data):
+        handle_users_reply(bot, Update.de_json(update_data, bot), job_queue)
+
+    try:
+        products = get_catalog_products()
+        for name in args.scenario or sorted(SCENARIOS):
+            fake_services.reset_calls()
+            report = run_scenario(
+                name, SCENARIOS[name], args.users, args.concurrency, products, handle_update,
+            )
+            print_report(name, report, fake_services.calls)
+    finally:
+        time.sleep(CART_SYNC_DELAY)
+        created_keys = set(db.scan_iter()) - existing_keys
+        if created_keys:
+            db.delete(*created_keys)
+        fake_services.stop()
+
+
+if __name__ == '__main__':
+    main()
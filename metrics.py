@@ -0,0 +1,126 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_gauges = {}
+_trace = threading.local()
+
+
+def _get_key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, **extra_labels):
+    labels = dict(labels, **extra_labels)
+    if not labels:
+        return ''
+    formatted = ','.join(f'{key}="{value}"' for key, value in labels.items())
+    return f'{{{formatted}}}'
+
+
+def increment(name, value=1, **labels):
+    key = _get_key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, seconds, **labels):
+    key = _get_key(name, labels)
+    with _lock:
+        buckets, total, count = _histograms.get(key, ([0] * len(BUCKETS), 0, 0))
+        buckets = [
+            bucket_count + (seconds <= bound)
+            for bucket_count, bound in zip(buckets, BUCKETS)
+        ]
+        _histograms[key] = (buckets, total + seconds, count + 1)
+    add_to_trace(name, labels, seconds)
+
+
+def register_gauge(name, callback):
+    _gauges[name] = callback
+
+
+def start_trace():
+    _trace.calls = []
+
+
+def add_to_trace(name, labels, seconds):
+    calls = getattr(_trace, 'calls', None)
+    if calls is not None:
+        description = ' '.join(str(value) for value in labels.values()) or name
+        calls.append((description, seconds))
+
+
+def finish_trace():
+    calls = getattr(_trace, 'calls', None) or []
+    _trace.calls = None
+    return calls
+
+
+def render_metrics():
+    lines = []
+    with _lock:
+        counters = dict(_counters)
+        histograms = dict(_histograms)
+    for name in sorted({name for name, _ in counters}):
+        lines.append(f'# TYPE {name} counter')
+        for (counter_name, labels), value in counters.items():
+            if counter_name == name:
+                lines.append(f'{name}{_format_labels(labels)} {value}')
+    for name in sorted({name for name, _ in histograms}):
+        lines.append(f'# TYPE {name} histogram')
+        for (histogram_name, labels), (buckets, total, count) in histograms.items():
+            if histogram_name != name:
+                continue
+            labels = dict(labels)
+            for bound, bucket_count in zip(BUCKETS, buckets):
+                lines.append(f'{name}_bucket{_format_labels(labels, le=bound)} {bucket_count}')
+            lines.append(f'{name}_bucket{_format_labels(labels, le="+Inf")} {count}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {total}')
+            lines.append(f'{name}_count{_format_labels(labels)} {count}')
+    for name, callback in sorted(_gauges.items()):
+        lines.append(f'# TYPE {name} gauge')
+        lines.append(f'{name} {callback()}')
+    return '\n'.join(lines) + '\n'
+
+
+class Timer:
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started_at = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe(self.name, time.monotonic() - self.started_at, **self.labels)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = render_metrics().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port):
+    server = ThreadingHTTPServer(('0.0.0.0', port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
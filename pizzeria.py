@@ -1,16 +1,91 @@
+import hashlib
 import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import slugify
+from catalog import invalidate_catalog
+from pizzeria_distance import invalidate_pizzerias_index
 from elasticpath import (
     create_product, upload_file, create_relationships,
-    create_entry,
+    create_entry, fetch_products, update_product, delete_product,
+    fetch_files, update_entry, delete_entry, get_entries,
 )
 
 
-def create_products(json_filename):
-    with open(json_filename, 'r') as f:
-        menu = json.load(f)
+IMPORT_WORKERS = int(os.getenv('IMPORT_WORKERS', 8))
+
+
+def get_content_hash(fields):
+    content = json.dumps(fields, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def get_image_filename(image_url):
+    url_hash = hashlib.sha1(image_url.encode('utf-8')).hexdigest()[:16]
+    return f"{url_hash}-{image_url.split('/')[-1]}"
+
+
+def get_product_fields(menu_item):
+    return {
+        'name': menu_item['name'],
+        'slug': slugify.slugify(menu_item['name']),
+        'description': menu_item['description'],
+        'price': [
+            {
+                'amount': menu_item['price'],
+                'currency': 'RUB',
+                'includes_tax': True,
+            }
+        ],
+    }
+
+
+def get_existing_product_fields(product):
+    return {
+        'name': product['name'],
+        'slug': product['slug'],
+        'description': product['description'],
+        'price': [
+            {
+                'amount': price['amount'],
+                'currency': price['currency'],
+                'includes_tax': price['includes_tax'],
+            }
+            for price in product['price']
+        ],
+    }
+
 
-    for menu_item in menu:
+def get_pizzeria_fields(pizzeria):
+    return {
+        'address': pizzeria['address']['full'],
+        'alias': pizzeria['alias'],
+        'Longitude': pizzeria['coordinates']['lon'],
+        'Latitude': pizzeria['coordinates']['lat'],
+    }
+
+
+def get_comparable_pizzeria_fields(fields):
+    comparable_fields = dict(fields)
+    for key in ('Longitude', 'Latitude'):
+        if comparable_fields.get(key) is not None:
+            comparable_fields[key] = float(comparable_fields[key])
+    return comparable_fields
+
+
+def upload_product_image(product_id, image_url):
+    file_id = upload_file(file_url=image_url, filename=get_image_filename(image_url))
+    create_relationships(product_id, file_id)
+
+
+def import_menu_item(menu_item, existing_product):
+    if existing_product:
+        if existing_product.get('relationships', {}).get('main_image'):
+            return 'skipped'
+        product_id = existing_product['id']
+    else:
         product_id = create_product(
             name=menu_item['name'],
             slug=slugify.slugify(menu_item["name"]),
@@ -18,8 +93,107 @@ def create_products(json_filename):
             description=menu_item['description'],
             amount=menu_item['price'],
         )
-        file_id = upload_file(file_url=menu_item['product_image']['url'])
-        create_relationships(product_id, file_id)
+    upload_product_image(product_id, menu_item['product_image']['url'])
+    return 'created' if not existing_product else 'resumed'
+
+
+def sync_menu_item(menu_item, product, file_names):
+    if product is None:
+        return import_menu_item(menu_item, None)
+
+    result = 'unchanged'
+    fields = get_product_fields(menu_item)
+    if get_content_hash(fields) != get_content_hash(get_existing_product_fields(product)):
+        update_product(product['id'], fields)
+        result = 'updated'
+
+    image_url = menu_item['product_image']['url']
+    main_image = product.get('relationships', {}).get('main_image')
+    if not main_image or file_names.get(main_image['data']['id']) != get_image_filename(image_url):
+        upload_product_image(product['id'], image_url)
+        result = 'updated'
+    return result
+
+
+def sync_pizzeria(pizzeria, entry):
+    fields = get_pizzeria_fields(pizzeria)
+    if entry is None:
+        create_entry(flow_slug='pizzeria', data=fields)
+        return 'created'
+    existing_fields = {key: entry.get(key) for key in fields}
+    if get_content_hash(get_comparable_pizzeria_fields(fields)) == \
+            get_content_hash(get_comparable_pizzeria_fields(existing_fields)):
+        return 'unchanged'
+    update_entry(flow_slug='pizzeria', entry_id=entry['id'], data=fields)
+    return 'updated'
+
+
+def print_progress(done, total, started_at, results):
+    elapsed = time.monotonic() - started_at
+    rate = done / elapsed if elapsed else 0
+    counters = ', '.join(f'{result}: {count}' for result, count in results.items())
+    print(f'{done}/{total}, {rate:.1f} шт/с, {counters}')
+
+
+def run_tasks(tasks, workers=IMPORT_WORKERS):
+    results = {}
+    started_at = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(task): name for name, task in tasks}
+        for done, future in enumerate(as_completed(futures), start=1):
+            try:
+                result = future.result()
+            except Exception as err:
+                result = 'failed'
+                print(f'Ошибка при обработке {futures[future]}: {err}')
+            results[result] = results.get(result, 0) + 1
+            print_progress(done, len(tasks), started_at, results)
+    return results
+
+
+def create_products(json_filename, workers=IMPORT_WORKERS):
+    with open(json_filename, 'r') as f:
+        menu = json.load(f)
+
+    existing_products = {product['sku']: product for product in fetch_products()}
+    tasks = [
+        (
+            menu_item['name'],
+            lambda menu_item=menu_item: import_menu_item(
+                menu_item, existing_products.get(str(menu_item['id']))
+            ),
+        )
+        for menu_item in menu
+    ]
+    return run_tasks(tasks, workers=workers)
+
+
+def sync_products(json_filename, workers=IMPORT_WORKERS):
+    with open(json_filename, 'r') as f:
+        menu = json.load(f)
+
+    existing_products = {product['sku']: product for product in fetch_products()}
+    file_names = {file['id']: file['file_name'] for file in fetch_files()}
+    menu_skus = {str(menu_item['id']) for menu_item in menu}
+    tasks = [
+        (
+            menu_item['name'],
+            lambda menu_item=menu_item: sync_menu_item(
+                menu_item, existing_products.get(str(menu_item['id'])), file_names
+            ),
+        )
+        for menu_item in menu
+    ]
+    tasks += [
+        (
+            product['name'],
+            lambda product=product: delete_product(product['id']) or 'deleted',
+        )
+        for sku, product in existing_products.items() if sku not in menu_skus
+    ]
+    results = run_tasks(tasks, workers=workers)
+    invalidate_catalog()
+    return results
 
 
 def create_pizzerias(json_filename):
@@ -29,10 +203,32 @@ def create_pizzerias(json_filename):
     for pizzeria in pizzerias:
         create_entry(
             flow_slug='pizzeria',
-            data={
-                'address': pizzeria['address']['full'],
-                'alias': pizzeria['alias'],
-                'longitude': pizzeria['coordinates']['lon'],
-                'latitude': pizzeria['coordinates']['lat'],
-            },
+            data=get_pizzeria_fields(pizzeria),
+        )
+
+
+def sync_pizzerias(json_filename, workers=IMPORT_WORKERS):
+    with open(json_filename, 'r') as f:
+        pizzerias = json.load(f)
+
+    existing_entries = {entry['alias']: entry for entry in get_entries('pizzeria')}
+    aliases = {pizzeria['alias'] for pizzeria in pizzerias}
+    tasks = [
+        (
+            pizzeria['alias'],
+            lambda pizzeria=pizzeria: sync_pizzeria(
+                pizzeria, existing_entries.get(pizzeria['alias'])
+            ),
+        )
+        for pizzeria in pizzerias
+    ]
+    tasks += [
+        (
+            alias,
+            lambda entry=entry: delete_entry('pizzeria', entry['id']) or 'deleted',
         )
+        for alias, entry in existing_entries.items() if alias not in aliases
+    ]
+    results = run_tasks(tasks, workers=workers)
+    invalidate_pizzerias_index()
+    return results
@@ -1,22 +1,145 @@
+import heapq
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
 import requests
-from elasticpath import get_entries
+from database import InvalidationMarker
+from elasticpath import iterate_entries
+from http_client import send_request
+from metrics import increment
 from geopy import distance
 
 
-def get_nearest_pizzeria(current_pos):
-    pizzerias = get_entries('pizzeria')
-    for pizzeria in pizzerias:
+YANDEX_GEOCODER_URL = os.getenv('YANDEX_GEOCODER_URL', 'https://geocode-maps.yandex.ru')
+PIZZERIAS_TTL = int(os.getenv('PIZZERIAS_TTL', 60*60))
+NEAREST_CANDIDATES = 3
+GEOCODER_CACHE_SIZE = int(os.getenv('GEOCODER_CACHE_SIZE', 10000))
+GEOCODER_TTL = 30*24*60*60
+GEOCODER_NEGATIVE_TTL = 5*60
+
+_pizzerias_index = None
+_pizzerias_loaded_at = None
+_pizzerias_loaded_at_timestamp = 0
+_pizzerias_invalidation_marker = InvalidationMarker('pizzerias_invalidated_at')
+_geocoder_cache = OrderedDict()
+_geocoder_lock = threading.Lock()
+
+
+def to_unit_vector(point):
+    lat, lon = (math.radians(float(coordinate)) for coordinate in point)
+    return (
+        math.cos(lat) * math.cos(lon),
+        math.cos(lat) * math.sin(lon),
+        math.sin(lat),
+    )
+
+
+def build_pizzerias_index(pizzerias):
+    return [
+        (to_unit_vector((pizzeria['Longitude'], pizzeria['Latitude'])), pizzeria)
+        for pizzeria in pizzerias
+    ]
+
+
+def get_pizzerias_index():
+    global _pizzerias_index, _pizzerias_loaded_at, _pizzerias_loaded_at_timestamp
+    if _pizzerias_index is None or time.monotonic() - _pizzerias_loaded_at > PIZZERIAS_TTL \
+            or _pizzerias_invalidation_marker.is_set_after(_pizzerias_loaded_at_timestamp):
+        loaded_at_timestamp = time.time()
+        try:
+            _pizzerias_index = build_pizzerias_index(iterate_entries('pizzeria', prefetch=True))
+            _pizzerias_loaded_at_timestamp = loaded_at_timestamp
+        except requests.exceptions.RequestException:
+            if _pizzerias_index is None:
+                raise
+        _pizzerias_loaded_at = time.monotonic()
+    return _pizzerias_index
+
+
+def invalidate_pizzerias_index():
+    global _pizzerias_index
+    _pizzerias_index = None
+    _pizzerias_invalidation_marker.set()
+
+
+def get_nearest_pizzerias(current_pos, count=1, candidates_count=NEAREST_CANDIDATES):
+    x, y, z = to_unit_vector(current_pos)
+    candidates = heapq.nsmallest(
+        max(count, candidates_count),
+        get_pizzerias_index(),
+        key=lambda item: -(item[0][0]*x + item[0][1]*y + item[0][2]*z),
+    )
+    pizzerias = []
+    for _, pizzeria in candidates:
+        pizzeria = dict(pizzeria)
         pizzeria['distance'] = distance.distance(
             (pizzeria['Longitude'], pizzeria['Latitude']),
             current_pos,
         ).km
-    return min(pizzerias, key=lambda x: x['distance'])
+        pizzerias.append(pizzeria)
+    pizzerias.sort(key=lambda x: x['distance'])
+    return pizzerias[:count]
+
+
+def get_nearest_pizzeria(current_pos):
+    nearest_pizzeria, *_ = get_nearest_pizzerias(current_pos)
+    return nearest_pizzeria
+
+
+def normalize_address(place):
+    return ' '.join(place.lower().replace(',', ' ').split())
+
+
+def get_cached_coordinates(key, db=None):
+    with _geocoder_lock:
+        cached = _geocoder_cache.get(key)
+        if cached:
+            coordinates, expires_at = cached
+            if time.monotonic() < expires_at:
+                _geocoder_cache.move_to_end(key)
+                return True, coordinates
+            del _geocoder_cache[key]
+    if db is not None:
+        stored = db.get(f'geocoder:{key}')
+        if stored is not None:
+            stored = stored.decode('utf-8')
+            coordinates = tuple(stored.split(' ')) if stored else None
+            ttl = GEOCODER_TTL if coordinates else GEOCODER_NEGATIVE_TTL
+            cache_coordinates(key, coordinates, ttl)
+            return True, coordinates
+    return False, None
+
+
+def cache_coordinates(key, coordinates, ttl, db=None):
+    with _geocoder_lock:
+        _geocoder_cache[key] = (coordinates, time.monotonic() + ttl)
+        _geocoder_cache.move_to_end(key)
+        while len(_geocoder_cache) > GEOCODER_CACHE_SIZE:
+            _geocoder_cache.popitem(last=False)
+    if db is not None:
+        stored = ' '.join(coordinates) if coordinates else ''
+        db.set(f'geocoder:{key}', stored, ex=ttl)
+
+
+def fetch_coordinates(apikey, place, db=None):
+    key = normalize_address(place)
+    found, coordinates = get_cached_coordinates(key, db=db)
+    increment('bot_cache_requests_total', cache='geocoder', result='hit' if found else 'miss')
+    if found:
+        return coordinates
+    coordinates = request_coordinates(apikey, place)
+    ttl = GEOCODER_TTL if coordinates else GEOCODER_NEGATIVE_TTL
+    cache_coordinates(key, coordinates, ttl, db=db)
+    return coordinates
 
 
-def fetch_coordinates(apikey, place):
-    base_url = "https://geocode-maps.yandex.ru/1.x"
+def request_coordinates(apikey, place):
+    base_url = f"{YANDEX_GEOCODER_URL}/1.x"
     params = {"geocode": place, "apikey": apikey, "format": "json"}
-    response = requests.get(base_url, params=params)
+    response = send_request('get', base_url, params=params)
     response.raise_for_status()
     try:
         places_found = response.json()['response']['GeoObjectCollection']['featureMember']
@@ -0,0 +1,26 @@
+from telegram.error import BadRequest
+
+from catalog import get_catalog_image_url
+from metrics import increment
+
+
+def get_photo_file_id(db, image_id):
+    file_id = db.hget('image_photos', image_id)
+    return file_id.decode('utf-8') if file_id else None
+
+
+def send_product_photo(bot, db, chat_id, product, **kwargs):
+    image_id = product['relationships']['main_image']['data']['id']
+    file_id = get_photo_file_id(db, image_id)
+    increment('bot_cache_requests_total', cache='photo_file_id', result='hit' if file_id else 'miss')
+    if file_id:
+        try:
+            return bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+        except BadRequest:
+            db.hdel('image_photos', image_id)
+
+    image_url = get_catalog_image_url(file_id=image_id)
+    message = bot.send_photo(chat_id=chat_id, photo=image_url, **kwargs)
+    if message.photo:
+        db.hset('image_photos', image_id, message.photo[-1].file_id)
+    return message
@@ -0,0 +1,144 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+from telegram.error import RetryAfter
+
+from metrics import increment, register_gauge
+
+
+INTERACTIVE = 0
+NOTIFICATION = 1
+
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', 30))
+TELEGRAM_CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', 1))
+TELEGRAM_CHAT_BURST = 3
+SEND_WORKERS = int(os.getenv('SEND_WORKERS', 4))
+THROTTLED_METHOD_PREFIXES = ('send', 'edit', 'forward')
+
+_priority = threading.local()
+
+
+@contextmanager
+def notification_priority():
+    _priority.value = NOTIFICATION
+    try:
+        yield
+    finally:
+        _priority.value = INTERACTIVE
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def get_wait_time(self):
+        self.refill()
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, seconds):
+        self.refill()
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    def is_full(self):
+        self.refill()
+        return self.tokens >= self.capacity
+
+
+class SendScheduler:
+    def __init__(self, workers=SEND_WORKERS, global_rate=TELEGRAM_GLOBAL_RATE):
+        self.condition = threading.Condition()
+        self.queue = []
+        self.counter = itertools.count()
+        self.global_bucket = TokenBucket(global_rate, max(global_rate, 1))
+        self.chat_buckets = {}
+        for _ in range(workers):
+            threading.Thread(target=self.run_worker, daemon=True).start()
+        register_gauge('bot_send_queue_depth', lambda: len(self.queue))
+
+    def call(self, chat_id, func, *args, **kwargs):
+        future = Future()
+        priority = getattr(_priority, 'value', INTERACTIVE)
+        with self.condition:
+            heapq.heappush(
+                self.queue,
+                (priority, next(self.counter), chat_id, future, func, args, kwargs),
+            )
+            self.condition.notify()
+        return future.result()
+
+    def get_chat_bucket(self, chat_id):
+        if len(self.chat_buckets) > 10000:
+            self.chat_buckets = {
+                bucket_chat_id: bucket for bucket_chat_id, bucket in self.chat_buckets.items()
+                if not bucket.is_full()
+            }
+        if chat_id not in self.chat_buckets:
+            self.chat_buckets[chat_id] = TokenBucket(TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST)
+        return self.chat_buckets[chat_id]
+
+    def take_ready_job(self):
+        if not self.queue:
+            return None, None
+        wait_time = self.global_bucket.get_wait_time()
+        if wait_time > 0:
+            return None, wait_time
+        chat_wait_times = []
+        for job in sorted(self.queue):
+            chat_bucket = self.get_chat_bucket(job[2])
+            chat_wait_time = chat_bucket.get_wait_time()
+            if chat_wait_time > 0:
+                chat_wait_times.append(chat_wait_time)
+                continue
+            self.queue.remove(job)
+            heapq.heapify(self.queue)
+            self.global_bucket.take()
+            chat_bucket.take()
+            return job, None
+        return None, min(chat_wait_times)
+
+    def run_worker(self):
+        while True:
+            with self.condition:
+                job, wait_time = self.take_ready_job()
+                while job is None:
+                    self.condition.wait(wait_time)
+                    job, wait_time = self.take_ready_job()
+            priority, order, chat_id, future, func, args, kwargs = job
+            try:
+                future.set_result(func(*args, **kwargs))
+            except RetryAfter as err:
+                increment('bot_telegram_retry_after_total')
+                with self.condition:
+                    self.get_chat_bucket(chat_id).block(err.retry_after)
+                    heapq.heappush(self.queue, job)
+                    self.condition.notify_all()
+            except Exception as err:
+                future.set_exception(err)
+
+
+def schedule_telegram_requests(bot, scheduler):
+    request_post = bot._request.post
+
+    def post(url, data, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        if not api_method.startswith(THROTTLED_METHOD_PREFIXES):
+            return request_post(url, data, *args, **kwargs)
+        return scheduler.call(data.get('chat_id'), request_post, url, data, *args, **kwargs)
+
+    bot._request.post = post
@@ -0,0 +1,50 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import increment
+
+
+SESSION_TTL = int(os.getenv('SESSION_TTL', 14*24*60*60))
+SESSION_CACHE_SIZE = int(os.getenv('SESSION_CACHE_SIZE', 10000))
+SESSION_CACHE_TTL = 5*60
+
+_lock = threading.Lock()
+_states = OrderedDict()
+
+
+def _cache_state(chat_id, state):
+    with _lock:
+        _states[chat_id] = (state, time.monotonic() + SESSION_CACHE_TTL)
+        _states.move_to_end(chat_id)
+        while len(_states) > SESSION_CACHE_SIZE:
+            _states.popitem(last=False)
+
+
+def get_user_state(db, chat_id):
+    with _lock:
+        cached = _states.get(chat_id)
+    if cached and time.monotonic() < cached[1]:
+        increment('bot_cache_requests_total', cache='session_state', result='hit')
+        return cached[0]
+    increment('bot_cache_requests_total', cache='session_state', result='miss')
+
+    pipe = db.pipeline(transaction=False)
+    pipe.get(chat_id)
+    pipe.expire(chat_id, SESSION_TTL)
+    state, _ = pipe.execute()
+    if state is None:
+        return None
+    state = state.decode("utf-8")
+    _cache_state(chat_id, state)
+    return state
+
+
+def set_user_state(db, chat_id, state):
+    with _lock:
+        cached = _states.get(chat_id)
+    if cached and cached[0] == state and time.monotonic() < cached[1]:
+        return
+    db.set(chat_id, state, ex=SESSION_TTL)
+    _cache_state(chat_id, state)
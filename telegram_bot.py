@@ -1,6 +1,6 @@
 import os
 import logging
-import redis
+import time
 
 from telegram_logger import TelegramLogsHandler
 from telegram.ext import Filters, Updater
@@ -10,39 +10,82 @@ from telegram.ext import (
 )
 from telegram import LabeledPrice
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ParseMode
+from telegram.error import BadRequest
 from validate_email import validate_email
 
 from elasticpath import (
-    fetch_products, get_product, get_image_url,
-    add_to_cart, get_carts_products, get_total_price,
-    remove_from_cart, create_customer, get_entries,
-    create_entry,
+    get_cart_summary, create_customer,
 )
 from pizzeria_distance import get_nearest_pizzeria, fetch_coordinates
+from cart_mirror import (
+    add_to_cart_mirror, remove_from_cart_mirror, reconcile_cart,
+)
+from database import get_database_connection
+from session_state import get_user_state, set_user_state
+from product_photos import send_product_photo
+from courier_dispatch import DISPATCH_WINDOW, callback_dispatch, enqueue_delivery
+from send_scheduler import (
+    TELEGRAM_GLOBAL_RATE, SendScheduler, notification_priority,
+    schedule_telegram_requests,
+)
+from metrics import Timer, start_trace, finish_trace, start_metrics_server
+from chat_dispatcher import ChatDispatcher, record_handler_latency
+from customer_address import save_customer_address, get_customer_address
+from catalog import (
+    get_catalog_products, get_catalog_product, get_catalog_version,
+)
 
-_database = None
+chat_dispatcher = None
+_menu_markups = {}
+_menu_markups_version = None
 logger = logging.getLogger("dvmn_bot_telegram")
 
 PRODUCTS_ON_PAGE = 8
 DELIVERY_TIME = 60*60
+SLOW_REQUEST_SECONDS = float(os.getenv('SLOW_REQUEST_SECONDS', 0))
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
 
 
 def start(bot, update, job_queue):
     reply_markup = get_menu_keyboard_markup()
-    update.message.reply_text('Выберите пиццу:', reply_markup=reply_markup)
+    update.effective_message.reply_text('Выберите пиццу:', reply_markup=reply_markup)
     return "HANDLE_MENU"
 
 
-def handle_menu(bot, update, job_queue):
-    query = update.callback_query
+def render_text(bot, query, text, reply_markup=None, parse_mode=None):
+    if query.message.text is not None:
+        try:
+            bot.edit_message_text(
+                text=text,
+                chat_id=query.message.chat_id,
+                message_id=query.message.message_id,
+                reply_markup=reply_markup,
+                parse_mode=parse_mode,
+            )
+            return
+        except BadRequest as err:
+            if 'message is not modified' in str(err).lower():
+                return
     bot.delete_message(
         chat_id=query.message.chat_id,
         message_id=query.message.message_id,
     )
+    bot.send_message(
+        text=text,
+        chat_id=query.message.chat_id,
+        reply_markup=reply_markup,
+        parse_mode=parse_mode,
+    )
+
+
+def handle_menu(bot, update, job_queue):
+    query = update.callback_query
     if query.data == 'HANDLE_CART':
         keyboard = []
         cart_info = ''
-        for item in get_carts_products(chat_id=query.message.chat_id):
+        reconcile_cart(db=get_database_connection(), chat_id=query.message.chat_id)
+        cart_summary = get_cart_summary(chat_id=query.message.chat_id)
+        for item in cart_summary['items']:
             product_cart_id = item['id']
             name = item['name']
             description = item['description']
@@ -57,14 +100,15 @@ def handle_menu(bot, update, job_queue):
                     f'Убрать из корзины {name}', callback_data=product_cart_id
                 )]
             )
-        cart_info += f'<b>Всего:</b> {get_total_price(chat_id=query.message.chat_id)}'
+        cart_info += f"<b>Всего:</b> {cart_summary['amount']} руб"
         keyboard += [
             [InlineKeyboardButton('Оплатить', callback_data='WAITING_EMAIL')],
             [InlineKeyboardButton('В меню', callback_data='HANDLE_MENU')]
         ]
-        bot.send_message(
+        render_text(
+            bot=bot,
+            query=query,
             text=cart_info,
-            chat_id=query.message.chat_id,
             reply_markup=InlineKeyboardMarkup(keyboard),
             parse_mode=ParseMode.HTML,
         )
@@ -72,19 +116,17 @@ def handle_menu(bot, update, job_queue):
 
     if 'page' in query.data:
         page = int(query.data.split(' ')[-1])
-        bot.send_message(
+        render_text(
+            bot=bot,
+            query=query,
             text='Meню:',
-            chat_id=query.message.chat_id,
             reply_markup=get_menu_keyboard_markup(page=page),
         )
         return 'HANDLE_MENU'
 
-    product = get_product(product_id=query.data)
+    product = get_catalog_product(product_id=query.data)
     price_data, *_ = product['price']
     product_info = f"{product['name']}\n{product['description']}\nЦена {price_data['amount']} {price_data['currency']}\n"
-    image_url = get_image_url(
-        id=product['relationships']['main_image']['data']['id']
-    )
     choise_keyboard = [
         InlineKeyboardButton(
             f'+{quantity}', callback_data=f'{query.data} {quantity}'
@@ -94,9 +136,15 @@ def handle_menu(bot, update, job_queue):
         choise_keyboard,
         [InlineKeyboardButton('Назад', callback_data='HANDLE_MENU')],
     ]
-    bot.send_photo(
+    bot.delete_message(
         chat_id=query.message.chat_id,
-        photo=image_url,
+        message_id=query.message.message_id,
+    )
+    send_product_photo(
+        bot=bot,
+        db=get_database_connection(),
+        chat_id=query.message.chat_id,
+        product=product,
         caption=product_info,
         reply_markup=InlineKeyboardMarkup(keyboard),
     )
@@ -106,22 +154,20 @@ def handle_menu(bot, update, job_queue):
 def handle_description(bot, update, job_queue):
     query = update.callback_query
     if query.data == 'HANDLE_MENU':
-        bot.delete_message(
-            chat_id=query.message.chat_id,
-            message_id=query.message.message_id,
-        )
-        bot.send_message(
+        render_text(
+            bot=bot,
+            query=query,
             text='Meню:',
-            chat_id=query.message.chat_id,
             reply_markup=get_menu_keyboard_markup(),
         )
         return 'HANDLE_MENU'
 
     product_id, quantity = query.data.split(' ')
-    add_to_cart(
+    add_to_cart_mirror(
+        db=get_database_connection(),
+        chat_id=query.message.chat_id,
         product_id=product_id,
         quantity=quantity,
-        chat_id=query.message.chat_id
     )
     bot.answer_callback_query(
         callback_query_id=update.callback_query.id,
@@ -133,28 +179,22 @@ def handle_description(bot, update, job_queue):
 def handle_cart(bot, update, job_queue):
     query = update.callback_query
     if query.data == 'WAITING_EMAIL':
-        bot.delete_message(
-            chat_id=query.message.chat_id,
-            message_id=query.message.message_id,
-        )
-        bot.send_message(
-            text='Введите ваш емайл:',
-            chat_id=query.message.chat_id,
-        )
+        render_text(bot=bot, query=query, text='Введите ваш емайл:')
         return 'WAITING_EMAIL'
     if query.data == 'HANDLE_MENU':
-        bot.delete_message(
-            chat_id=query.message.chat_id,
-            message_id=query.message.message_id,
-        )
-        bot.send_message(
+        render_text(
+            bot=bot,
+            query=query,
             text='Meню:',
-            chat_id=query.message.chat_id,
             reply_markup=get_menu_keyboard_markup(),
         )
         return 'HANDLE_MENU'
 
-    remove_from_cart(product_id=query.data, chat_id=query.message.chat_id)
+    remove_from_cart_mirror(
+        db=get_database_connection(),
+        chat_id=query.message.chat_id,
+        item_id=query.data,
+    )
     return 'HANDLE_CART'
 
 
@@ -177,29 +217,43 @@ def waiting_email(bot, update, job_queue):
     return 'HANDLE_WAITING_ADDRESS'
 
 
+def build_menu_keyboard_markups(products):
+    markups = {}
+    pages_count = max(1, -(-len(products) // PRODUCTS_ON_PAGE))
+    for page in range(1, pages_count + 1):
+        first_product_num = (page-1)*PRODUCTS_ON_PAGE
+        last_product_num = min(page*PRODUCTS_ON_PAGE, len(products))
+        navigation_list = [] if page == 1 else [InlineKeyboardButton('<<<', callback_data=f'page {page-1}')]
+        if page < pages_count:
+            navigation_list.append(InlineKeyboardButton('>>>', callback_data=f'page {page+1}'))
+        keyboard = [
+            [InlineKeyboardButton(prod['name'], callback_data=prod['id'])] for prod in products[first_product_num:last_product_num]
+        ]
+        keyboard.append(navigation_list)
+        keyboard.append([InlineKeyboardButton('Корзина', callback_data='HANDLE_CART')])
+        markups[page] = InlineKeyboardMarkup(keyboard)
+    return markups
+
+
 def get_menu_keyboard_markup(page=1):
-    products = fetch_products()
-    first_product_num = (page-1)*PRODUCTS_ON_PAGE
-    navigation_list = [] if page == 1 else [InlineKeyboardButton('<<<', callback_data=f'page {page-1}')]
-    if page*PRODUCTS_ON_PAGE < len(products):
-        last_product_num = page*PRODUCTS_ON_PAGE
-        navigation_list.append(InlineKeyboardButton('>>>', callback_data=f'page {page+1}'))
-    else:
-        last_product_num = len(products)
-    keyboard = [
-        [InlineKeyboardButton(prod['name'], callback_data=prod['id'])] for prod in products[first_product_num:last_product_num]
-    ]
-    keyboard.append(navigation_list)
-    keyboard.append([InlineKeyboardButton('Корзина', callback_data='HANDLE_CART')])
-    return InlineKeyboardMarkup(keyboard)
+    global _menu_markups, _menu_markups_version
+    catalog_version = get_catalog_version()
+    if catalog_version != _menu_markups_version:
+        _menu_markups = build_menu_keyboard_markups(get_catalog_products())
+        _menu_markups_version = catalog_version
+    return _menu_markups.get(page) or _menu_markups[1]
 
 
 def handle_waiting_address(bot, update, job_queue):
     message = update.effective_message
     if message.location:
-        current_pos = (message.location.latitude, message.location.longitude)
+        current_pos = (message.location.longitude, message.location.latitude)
     else:
-        current_pos = (fetch_coordinates(apikey=os.getenv('YANDEX_GEO_API'), place=update.message.text))
+        current_pos = fetch_coordinates(
+            apikey=os.getenv('YANDEX_GEO_API'),
+            place=update.message.text,
+            db=get_database_connection(),
+        )
         if not current_pos:
             bot.send_message(
                 text='Введите корректный адрес',
@@ -239,11 +293,13 @@ def handle_waiting_address(bot, update, job_queue):
         будет стоить 300 руб.
         '''
     longitude, latitude = current_pos
-    create_entry(flow_slug='customeraddress', data={
-        'telegram_chat_id': update.message.chat_id,
-        'longitude': longitude,
-        'latitude': latitude,
-    })
+    save_customer_address(
+        db=get_database_connection(),
+        chat_id=update.message.chat_id,
+        longitude=longitude,
+        latitude=latitude,
+        pizzeria=nearest_pizzeria,
+    )
     bot.send_message(
         text=text,
         chat_id=update.message.chat_id,
@@ -261,22 +317,21 @@ def handle_waiting_address(bot, update, job_queue):
 
 
 def callback_alarm(bot, job):
-    bot.send_message(
-        chat_id=job.context,
-        text='Приятного аппетита! *место для рекламы* *сообщение что делать если пицца не пришла*',
-    )
+    with notification_priority():
+        bot.send_message(
+            chat_id=job.context,
+            text='Приятного аппетита! *место для рекламы* *сообщение что делать если пицца не пришла*',
+        )
 
 
 def handle_waiting_delivery_choice(bot, update, job_queue):
     query = update.callback_query
     job_queue.run_once(callback_alarm, DELIVERY_TIME, context=query.message.chat_id)
-    customer_addresses = get_entries('customeraddress')
-    customer_address, *_ = [
-        address for address in customer_addresses if address['telegram_chat_id'] == str(query.message.chat_id)
-    ]
-    pizzeria = get_nearest_pizzeria(
-        (customer_address['longitude'], customer_address['latitude'])
+    customer_address = get_customer_address(
+        db=get_database_connection(),
+        chat_id=query.message.chat_id,
     )
+    pizzeria = customer_address['pizzeria']
     if query.data == 'PICKUP':
         bot.delete_message(
             chat_id=query.message.chat_id,
@@ -288,12 +343,10 @@ def handle_waiting_delivery_choice(bot, update, job_queue):
         )
         send_invoice(bot, update, job_queue)
         return 'START'
-    bot.send_message(
-        text='Клиент заказал пиццу, надо доставить',
-        chat_id=pizzeria['deliver_telegram_id'],
-    )
-    bot.send_location(
-        chat_id=pizzeria['deliver_telegram_id'],
+    enqueue_delivery(
+        db=get_database_connection(),
+        pizzeria=pizzeria,
+        chat_id=query.message.chat_id,
         longitude=customer_address['longitude'],
         latitude=customer_address['latitude'],
     )
@@ -309,7 +362,8 @@ def send_invoice(bot, update, job_queue):
     provider_token = os.getenv('TRANZZO_API')
     start_parameter = "test-payment"
     currency = "RUB"
-    price = int(float(get_total_price(chat_id).replace(' ',''))*100)
+    reconcile_cart(db=get_database_connection(), chat_id=chat_id)
+    price = get_cart_summary(chat_id)['total']
     prices = [LabeledPrice("Test", price)]
 
     bot.sendInvoice(chat_id, title, description, payload,
@@ -329,6 +383,21 @@ def successful_payment_callback(bot, update):
     update.message.reply_text("Оплата успешно получена!")
 
 
+def get_chat_id(update):
+    if update.message:
+        return update.message.chat_id
+    if update.callback_query:
+        return update.callback_query.message.chat_id
+    return None
+
+
+def dispatch_users_reply(bot, update, job_queue):
+    chat_id = get_chat_id(update)
+    if chat_id is None:
+        return
+    chat_dispatcher.submit(chat_id, handle_users_reply, bot, update, job_queue)
+
+
 def handle_users_reply(bot, update, job_queue):
     db = get_database_connection()
     if update.message:
@@ -339,10 +408,9 @@ def handle_users_reply(bot, update, job_queue):
         chat_id = update.callback_query.message.chat_id
     else:
         return
-    if user_reply == '/start':
+    user_state = None if user_reply == '/start' else get_user_state(db, chat_id)
+    if user_state is None:
         user_state = 'START'
-    else:
-        user_state = db.get(chat_id).decode("utf-8")
 
     states_functions = {
         'START': start,
@@ -354,27 +422,36 @@ def handle_users_reply(bot, update, job_queue):
         'HANDLE_WAITING_DELIVERY_CHOICE': handle_waiting_delivery_choice,
     }
     state_handler = states_functions[user_state]
-    next_state = state_handler(bot, update, job_queue)
-    db.set(chat_id, next_state)
-
-
-def get_database_connection():
-    global _database
-    if _database is None:
-        database_password = os.getenv("REDIS_PASSWORD")
-        database_host = os.getenv("REDIS_HOST")
-        database_port = os.getenv("REDIS_PORT")
-        _database = redis.Redis(
-            host=database_host, port=database_port, password=database_password
-        )
-    return _database
+    start_trace()
+    started_at = time.monotonic()
+    try:
+        next_state = state_handler(bot, update, job_queue)
+    finally:
+        duration = time.monotonic() - started_at
+        calls = finish_trace()
+        record_handler_latency(state_handler.__name__, duration)
+        if SLOW_REQUEST_SECONDS and duration > SLOW_REQUEST_SECONDS:
+            breakdown = ', '.join(f'{call} {seconds:.3f}с' for call, seconds in calls)
+            logger.warning(f'Медленный ответ {state_handler.__name__} {duration:.3f}с: {breakdown}')
+    set_user_state(db, chat_id, next_state)
+
+
+def instrument_telegram_bot(bot):
+    request_post = bot._request.post
+
+    def post(url, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        with Timer('bot_upstream_request_duration_seconds', host='api.telegram.org', method=api_method):
+            return request_post(url, *args, **kwargs)
+
+    bot._request.post = post
 
 
 def error_handler(bot, update, job_queue, err):
     logger.error(err)
 
 
-if __name__ == '__main__':
+def setup_logging():
     debug_bot_token = os.environ['DEBUG_TELEGRAM_BOT_TOKEN']
     debug_chat_id = os.environ['DEBUG_TELEGRAM_CHAT_ID']
     logger.setLevel(logging.INFO)
@@ -383,17 +460,35 @@ if __name__ == '__main__':
         chat_id=debug_chat_id,
     ))
 
-    token = os.getenv('TELEGRAM_BOT_TOKEN')
+
+def create_updater(token, processes=1):
+    global chat_dispatcher
     updater = Updater(token)
+    instrument_telegram_bot(updater.bot)
+    schedule_telegram_requests(
+        updater.bot, SendScheduler(global_rate=TELEGRAM_GLOBAL_RATE / processes),
+    )
     dispatcher = updater.dispatcher
     dispatcher.add_error_handler(error_handler)
-    dispatcher.add_handler(CallbackQueryHandler(handle_users_reply, pass_job_queue=True))
-    dispatcher.add_handler(MessageHandler(Filters.text, handle_users_reply, pass_job_queue=True))
-    dispatcher.add_handler(MessageHandler(Filters.location, handle_users_reply, pass_job_queue=True))
-    dispatcher.add_handler(CommandHandler('start', handle_users_reply, pass_job_queue=True))
+    # Отправка ждет, пока у чата есть лимит, поэтому обработка идет в пуле, а не в потоке диспетчера
+    bot_workers = max(1, int(os.getenv('BOT_WORKERS', 8)))
+    chat_dispatcher = ChatDispatcher(workers=bot_workers)
+    dispatcher.add_handler(CallbackQueryHandler(dispatch_users_reply, pass_job_queue=True))
+    dispatcher.add_handler(MessageHandler(Filters.text, dispatch_users_reply, pass_job_queue=True))
+    dispatcher.add_handler(MessageHandler(Filters.location, dispatch_users_reply, pass_job_queue=True))
+    dispatcher.add_handler(CommandHandler('start', dispatch_users_reply, pass_job_queue=True))
 
     dispatcher.add_handler(PreCheckoutQueryHandler(precheckout_callback))
     dispatcher.add_handler(MessageHandler(Filters.successful_payment, successful_payment_callback))
+    updater.job_queue.run_repeating(callback_dispatch, DISPATCH_WINDOW)
+    return updater
+
 
+if __name__ == '__main__':
+    setup_logging()
+    token = os.getenv('TELEGRAM_BOT_TOKEN')
+    updater = create_updater(token)
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
     logger.info('Бот Интернет-магазина в Telegram запущен')
     updater.start_polling()
@@ -1,13 +1,74 @@
 import logging
+import queue
+import threading
+from collections import OrderedDict
+
 import telegram
 
 
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
 class TelegramLogsHandler(logging.Handler):
-    def __init__(self, debug_bot_token, chat_id):
+    def __init__(self, debug_bot_token, chat_id, flush_interval=5, queue_size=1000):
         super().__init__()
         self.debug_bot = telegram.Bot(debug_bot_token)
         self.chat_id = chat_id
+        self.flush_interval = flush_interval
+        self.records = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.closed = threading.Event()
+        self.sender = threading.Thread(target=self.send_batches, daemon=True)
+        self.sender.start()
 
     def emit(self, record):
-        log_entry = self.format(record)
-        self.debug_bot.send_message(self.chat_id, text=log_entry)
+        try:
+            self.records.put_nowait(self.format(record))
+        except queue.Full:
+            self.dropped += 1
+
+    def collect_batch(self):
+        log_entries = OrderedDict()
+        while True:
+            try:
+                log_entry = self.records.get_nowait()
+            except queue.Empty:
+                break
+            log_entries[log_entry] = log_entries.get(log_entry, 0) + 1
+        return log_entries
+
+    def format_batch(self, log_entries):
+        lines = [
+            log_entry if count == 1 else f'{log_entry}\n(повторилось {count} раз)'
+            for log_entry, count in log_entries.items()
+        ]
+        if self.dropped:
+            lines.append(f'Пропущено сообщений: {self.dropped}')
+            self.dropped = 0
+        return '\n\n'.join(lines)
+
+    def send_batch(self):
+        log_entries = self.collect_batch()
+        if not log_entries and not self.dropped:
+            return
+        text = self.format_batch(log_entries)
+        for start in range(0, len(text), TELEGRAM_MESSAGE_LIMIT):
+            try:
+                self.debug_bot.send_message(
+                    self.chat_id, text=text[start:start+TELEGRAM_MESSAGE_LIMIT],
+                )
+            except telegram.error.TelegramError:
+                self.dropped += 1
+
+    def send_batches(self):
+        while not self.closed.wait(self.flush_interval):
+            self.send_batch()
+
+    def flush(self):
+        self.send_batch()
+
+    def close(self):
+        self.closed.set()
+        self.sender.join()
+        self.flush()
+        super().close()
@@ -0,0 +1,87 @@
+import json
+import logging
+import multiprocessing
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram import Bot
+
+from metrics import render_metrics
+from telegram_bot import setup_logging
+from workers import ShardedWorkers
+
+
+logger = logging.getLogger("dvmn_bot_telegram")
+
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    webhook_path = None
+    workers = None
+    updates_received = multiprocessing.Value('i', 0)
+
+    def send_text(self, status, text, content_type='text/plain; charset=utf-8'):
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path != self.webhook_path:
+            self.send_text(404, 'Not found')
+            return
+        content_length = int(self.headers.get('Content-Length', 0))
+        try:
+            update_data = json.loads(self.rfile.read(content_length))
+        except ValueError:
+            self.send_text(400, 'Bad request')
+            return
+        self.workers.put(update_data)
+        with self.updates_received.get_lock():
+            self.updates_received.value += 1
+        self.send_text(200, 'ok')
+
+    def do_GET(self):
+        if self.path == '/health':
+            alive_workers = self.workers.get_alive_count()
+            status = 200 if alive_workers == len(self.workers.processes) else 503
+            self.send_text(status, json.dumps({
+                'workers': len(self.workers.processes),
+                'alive_workers': alive_workers,
+            }), content_type='application/json')
+        elif self.path == '/metrics':
+            self.send_text(200, (
+                '# TYPE bot_updates_received_total counter\n'
+                f'bot_updates_received_total {self.updates_received.value}\n'
+                '# TYPE bot_updates_queue_depth gauge\n'
+                f'bot_updates_queue_depth {self.workers.get_queue_depth()}\n'
+                + render_metrics()
+            ), content_type='text/plain; version=0.0.4')
+        else:
+            self.send_text(404, 'Not found')
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+    token = os.getenv('TELEGRAM_BOT_TOKEN')
+    webhook_url = os.getenv('WEBHOOK_URL')
+    port = int(os.getenv('PORT', 8443))
+
+    workers = ShardedWorkers(token)
+    workers.start()
+    setup_logging()
+
+    WebhookRequestHandler.webhook_path = f'/{token}'
+    WebhookRequestHandler.workers = workers
+    if webhook_url:
+        Bot(token).set_webhook(url=f'{webhook_url.rstrip("/")}/{token}')
+
+    server = ThreadingHTTPServer(('0.0.0.0', port), WebhookRequestHandler)
+    logger.info('Бот Интернет-магазина в Telegram запущен в режиме webhook')
+    try:
+        server.serve_forever()
+    finally:
+        workers.stop()
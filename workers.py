@@ -0,0 +1,111 @@
+import logging
+import multiprocessing
+import os
+import threading
+
+from telegram import Update
+
+from metrics import start_metrics_server
+from telegram_bot import METRICS_PORT, create_updater, setup_logging
+
+
+BOT_PROCESSES = int(os.getenv('BOT_PROCESSES', multiprocessing.cpu_count()))
+
+logger = logging.getLogger("dvmn_bot_telegram")
+
+
+def get_update_chat_id(update_data):
+    for key in ('message', 'edited_message'):
+        if key in update_data:
+            return update_data[key]['chat']['id']
+    if 'callback_query' in update_data:
+        callback_query = update_data['callback_query']
+        if 'message' in callback_query:
+            return callback_query['message']['chat']['id']
+        return callback_query['from']['id']
+    for key in ('pre_checkout_query', 'shipping_query', 'inline_query'):
+        if key in update_data:
+            return update_data[key]['from']['id']
+    return 0
+
+
+def run_worker(token, updates_queue, worker_num, processes):
+    setup_logging()
+    updater = create_updater(token, processes=processes)
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT + worker_num)
+    updater.job_queue.start()
+    while True:
+        update_data = updates_queue.get()
+        if update_data is None:
+            break
+        update = Update.de_json(update_data, updater.bot)
+        updater.dispatcher.process_update(update)
+    updater.job_queue.stop()
+
+
+class ShardedWorkers:
+    def __init__(self, token, processes=BOT_PROCESSES):
+        self.token = token
+        self.lock = threading.Lock()
+        self.queues = [multiprocessing.Queue() for _ in range(processes)]
+        self.processes = [self.create_process(shard) for shard in range(processes)]
+
+    def create_process(self, shard):
+        return multiprocessing.Process(
+            target=run_worker,
+            args=(self.token, self.queues[shard], shard + 1, len(self.queues)),
+            daemon=True,
+        )
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+
+    def restart_dead_worker(self, shard):
+        with self.lock:
+            process = self.processes[shard]
+            if process.is_alive():
+                return
+            logger.error(f'Процесс {shard + 1} завершился с кодом {process.exitcode}, перезапускаю')
+            self.processes[shard] = self.create_process(shard)
+            self.processes[shard].start()
+
+    def put(self, update_data):
+        shard = get_update_chat_id(update_data) % len(self.queues)
+        if not self.processes[shard].is_alive():
+            self.restart_dead_worker(shard)
+        self.queues[shard].put(update_data)
+
+    def get_queue_depth(self):
+        return sum(updates_queue.qsize() for updates_queue in self.queues)
+
+    def get_alive_count(self):
+        return sum(process.is_alive() for process in self.processes)
+
+    def stop(self):
+        for updates_queue in self.queues:
+            updates_queue.put(None)
+        for process in self.processes:
+            process.join()
+
+
+def forward_update(bot, update):
+    sharded_workers.put(update.to_dict())
+
+
+if __name__ == '__main__':
+    from telegram.ext import TypeHandler, Updater
+    from telegram_bot import logger
+
+    token = os.getenv('TELEGRAM_BOT_TOKEN')
+    sharded_workers = ShardedWorkers(token)
+    sharded_workers.start()
+    setup_logging()
+
+    updater = Updater(token)
+    updater.dispatcher.add_handler(TypeHandler(Update, forward_update))
+    logger.info(f'Бот Интернет-магазина в Telegram запущен, процессов: {len(sharded_workers.processes)}')
+    updater.start_polling()
+    updater.idle()
+    sharded_workers.stop()